@@ -1,11 +1,17 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from flask_caching import Cache
 from psycopg2 import pool, OperationalError
 from dotenv import load_dotenv
+from cache_keys import PRICE_CACHE_KEY, PRICE_GENERATION_KEY
+import hashlib
+import orjson
 import os
+import redis
 import sys
+import threading
+import time
+import uuid
 import logging
 
 # Configure logging to stdout for Docker
@@ -24,8 +30,8 @@ cnxpool = None
 try:
     logger.info('Creating database connection pool')
     cnxpool = pool.ThreadedConnectionPool(
-        minconn=1,
-        maxconn=5,
+        minconn=int(os.getenv("DB_POOL_MIN", 4)),
+        maxconn=int(os.getenv("DB_POOL_MAX", 20)),
         host=os.getenv("DB_HOST"),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
@@ -41,14 +47,21 @@ except OperationalError as e:
 try:
     db = cnxpool.getconn()
     cursor = db.cursor()
+    # The (currency_id, timestamp) primary key serves the per-currency latest
+    # price lookups with a backward index scan; BRIN keeps time-range scans
+    # cheap on this append-only table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS coingecko (
-            id SERIAL PRIMARY KEY,
-            currency_id VARCHAR(255),
-            currency_value REAL,
-            timestamp TIMESTAMP(6) DEFAULT CURRENT_TIMESTAMP
+            currency_id VARCHAR(16) NOT NULL,
+            currency_value REAL NOT NULL,
+            timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (currency_id, timestamp)
         )
     """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_coingecko_ts_brin
+        ON coingecko USING BRIN (timestamp)
+    """)
     db.commit()
     cursor.close()
     cnxpool.putconn(db)
@@ -59,19 +72,77 @@ except Exception as e:
 
 app = Flask(__name__)
 
-# Configure Redis for caching
-app.config['CACHE_TYPE'] = 'redis'
-app.config['CACHE_REDIS_URL'] = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
-cache = Cache(app)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Fail fast on a hung or unreachable Redis so requests fall back to the
+# database or the last good /price body instead of blocking a worker thread
+REDIS_SOCKET_TIMEOUT = 0.5  # seconds
+REDIS_OPTIONS = {
+    'socket_connect_timeout': REDIS_SOCKET_TIMEOUT,
+    'socket_timeout': REDIS_SOCKET_TIMEOUT,
+}
+
+# Redis client for the /price cache, its rebuild lock and health checks
+cache_redis = redis.Redis.from_url(REDIS_URL, **REDIS_OPTIONS)
+
+# Deletes a lock key only if it still holds the caller's token
+release_lock = cache_redis.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) end return 0"
+)
 
-# Set up the rate limiter
+# Stores a /price body only if the generation still matches the one read
+# before querying the database (see cache_keys.PRICE_GENERATION_KEY)
+store_price_body = cache_redis.register_script(
+    "if (redis.call('get', KEYS[2]) or '') == ARGV[2] then "
+    "return redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[3]) end return false"
+)
+
+# Set up the rate limiter; counters live in Redis so the limit is shared
+# across all gunicorn workers instead of being enforced per process.
+# Set RATELIMIT_ENABLED=false when a reverse proxy already enforces it.
+app.config['RATELIMIT_ENABLED'] = os.getenv('RATELIMIT_ENABLED', 'true').lower() == 'true'
 limiter = Limiter(
-    app,
     key_func=get_remote_address,
+    app=app,
     default_limits=["1 per second"],
-    headers_enabled=True
+    storage_uri=REDIS_URL,
+    storage_options=REDIS_OPTIONS,
+    strategy="fixed-window",
+    headers_enabled=True,
+    # Keep limiting per process if Redis is unreachable instead of failing
+    # every request with a storage error
+    in_memory_fallback_enabled=True,
+    swallow_errors=True
 )
 
+# fetch_data invalidates the cached /price body after each insert, so the
+# TTL is only a safety net
+PRICE_CACHE_TIMEOUT = 60  # seconds
+# Cache-Control max-age sent to clients/CDNs for successful /price responses
+PRICE_MAX_AGE = 15  # seconds
+
+# Single-flight lock so only one worker rebuilds the /price body on a miss.
+# It holds a per-holder token and is only released by its holder, so a slow
+# rebuild can't delete a lock another worker took after it expired.
+PRICE_LOCK_KEY = 'price_lock'
+PRICE_LOCK_TIMEOUT = 5  # seconds
+PRICE_LOCK_POLL_INTERVAL = 0.05  # seconds
+PRICE_LOCK_POLL_ATTEMPTS = 10
+
+# Last body this process rebuilt successfully. It is served with
+# X-Cache: stale when Redis is unreachable or a rebuild fails or waits on
+# another worker's lock, as long as it is younger than PRICE_STALE_MAX_AGE.
+# While Redis is down, a body younger than PRICE_FRESH_AGE is served as a
+# normal response; older ones trigger one background refresh per process.
+PRICE_STALE_MAX_AGE = 300  # seconds
+PRICE_FRESH_AGE = 5  # seconds
+_last_good = {"body": None, "ts": 0.0}
+_refresh_lock = threading.Lock()
+
+# A healthy /health result is reused for this long before re-probing
+HEALTH_CACHE_TTL = 5  # seconds
+_health_cache = {"t": 0.0, "status": None}
+
 # Map full currency_id to short form
 CURRENCY_MAP = {
     'zenon-2': 'znn',
@@ -79,6 +150,9 @@ CURRENCY_MAP = {
     'bitcoin': 'btc',
     'ethereum': 'eth'
 }
+CURRENCY_IDS = tuple(CURRENCY_MAP)
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
 
 @app.errorhandler(429)
@@ -93,8 +167,19 @@ def internal_error_handler(e):
 
 
 @app.route("/health")
+@limiter.exempt
 def health():
-    """Health check endpoint for Docker/Kubernetes."""
+    """Health check endpoint for Docker/Kubernetes.
+
+    Healthy results are reused for HEALTH_CACHE_TTL seconds so frequent
+    probes don't take pooled connections from /price. Pass ?deep=1 to
+    force a fresh probe.
+    """
+    now = time.monotonic()
+    if (request.args.get("deep") != "1" and _health_cache["status"]
+            and now - _health_cache["t"] < HEALTH_CACHE_TTL):
+        return jsonify(_health_cache["status"]), 200
+
     health_status = {"status": "healthy", "checks": {}}
 
     # Check database connection
@@ -112,18 +197,23 @@ def health():
 
     # Check Redis/cache connection
     try:
-        cache.get("health_check_test")
+        cache_redis.ping()
         health_status["checks"]["cache"] = "ok"
     except Exception as e:
         logger.error(f'Health check cache error: {e}')
         health_status["status"] = "unhealthy"
         health_status["checks"]["cache"] = str(e)
 
-    status_code = 200 if health_status["status"] == "healthy" else 503
+    if health_status["status"] == "healthy":
+        _health_cache["t"] = now
+        _health_cache["status"] = health_status
+        status_code = 200
+    else:
+        _health_cache["status"] = None
+        status_code = 503
     return jsonify(health_status), status_code
 
 
-@cache.cached(timeout=30, key_prefix='all_prices')
 def get_prices():
     """Fetch latest prices from database."""
     db = None
@@ -131,16 +221,24 @@ def get_prices():
 
     try:
         db = cnxpool.getconn()
+        # Read-only lookup, so skip transaction setup entirely
+        db.set_session(readonly=True, autocommit=True)
         cursor = db.cursor()
 
+        # One LIMIT 1 primary key probe per currency; PostgreSQL has no skip
+        # scan, so DISTINCT ON would read every row for these currencies
         query = """
-            SELECT currency_id, currency_value, timestamp
-            FROM coingecko
-            WHERE currency_id IN ('zenon-2', 'quasar-2', 'bitcoin', 'ethereum')
-            ORDER BY timestamp DESC
-            LIMIT 4
+            SELECT c.id, l.currency_value, l.timestamp
+            FROM unnest(%s::text[]) AS c(id)
+            CROSS JOIN LATERAL (
+                SELECT currency_value, timestamp
+                FROM coingecko
+                WHERE currency_id = c.id
+                ORDER BY timestamp DESC
+                LIMIT 1
+            ) l
         """
-        cursor.execute(query)
+        cursor.execute(query, (list(CURRENCY_IDS),))
         results = cursor.fetchall()
 
         if not results:
@@ -154,7 +252,7 @@ def get_prices():
             short_code = CURRENCY_MAP.get(currency_id)
             if short_code:
                 prices[short_code] = {
-                    "timestamp": result[2].strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                    "timestamp": result[2].strftime(TIMESTAMP_FORMAT),
                     "usd": result[1]
                 }
             else:
@@ -175,10 +273,143 @@ def get_prices():
             cnxpool.putconn(db)
 
 
+def query_price_body():
+    """Query the database and serialize the /price body.
+
+    Returns the body and whether it holds price data. Successful bodies are
+    recorded as this process's last known good response.
+    """
+    result = get_prices()
+    body = orjson.dumps(result)
+    ok = "data" in result
+    if ok:
+        _last_good["body"] = body
+        _last_good["ts"] = time.monotonic()
+    return body, ok
+
+
+def build_price_body():
+    """Rebuild the serialized /price body, coalescing concurrent misses.
+
+    The first caller takes a short Redis lock and queries the database;
+    others poll the cache briefly and get (None, False) if the lock holder
+    does not publish a result in time. If Redis is unavailable the database
+    is queried directly. Returns the body and whether it holds price data
+    (error bodies are not cached).
+    """
+    token = uuid.uuid4().hex
+    try:
+        locked = bool(cache_redis.set(PRICE_LOCK_KEY, token, nx=True, ex=PRICE_LOCK_TIMEOUT))
+    except redis.RedisError as e:
+        logger.warning(f'Price cache unavailable, querying database directly: {e}')
+        return query_price_body()
+
+    if not locked:
+        try:
+            for _ in range(PRICE_LOCK_POLL_ATTEMPTS):
+                time.sleep(PRICE_LOCK_POLL_INTERVAL)
+                body = cache_redis.get(PRICE_CACHE_KEY)
+                if body is not None:
+                    return body, True
+        except redis.RedisError as e:
+            logger.warning(f'Price cache unavailable, querying database directly: {e}')
+            return query_price_body()
+        return None, False
+
+    try:
+        try:
+            generation = cache_redis.get(PRICE_GENERATION_KEY) or b''
+        except redis.RedisError as e:
+            logger.warning(f'Price cache unavailable, querying database directly: {e}')
+            generation = None
+
+        body, ok = query_price_body()
+        # Only cache successful lookups so errors are retried on the next hit
+        if ok and generation is not None:
+            try:
+                store_price_body(
+                    keys=[PRICE_CACHE_KEY, PRICE_GENERATION_KEY],
+                    args=[body, generation, PRICE_CACHE_TIMEOUT]
+                )
+            except redis.RedisError as e:
+                logger.warning(f'Failed to cache price body: {e}')
+        return body, ok
+    finally:
+        try:
+            release_lock(keys=[PRICE_LOCK_KEY], args=[token])
+        except redis.RedisError as e:
+            logger.warning(f'Failed to release price lock: {e}')
+
+
+def refresh_price_body():
+    """Rebuild the /price body in the background, then release the refresh flag."""
+    try:
+        build_price_body()
+    except Exception as e:
+        logger.error(f'Background price refresh failed: {e}')
+    finally:
+        _refresh_lock.release()
+
+
+def stale_price_response():
+    """Return the last good body marked as stale, or None if it is too old."""
+    body = _last_good["body"]
+    if body is None or time.monotonic() - _last_good["ts"] >= PRICE_STALE_MAX_AGE:
+        return None
+    response = Response(body, mimetype='application/json')
+    response.headers['X-Cache'] = 'stale'
+    return response
+
+
+def price_response(body, ok):
+    """Wrap a /price body, adding client caching headers when it holds data."""
+    response = Response(body, mimetype='application/json')
+    if ok:
+        # Let clients and CDNs reuse the response and revalidate with ETag
+        response.cache_control.public = True
+        response.cache_control.max_age = PRICE_MAX_AGE
+        response.set_etag(hashlib.md5(body).hexdigest())
+        response.make_conditional(request)
+    return response
+
+
+def outage_price_response():
+    """Serve /price while the Redis cache is unreachable."""
+    body = _last_good["body"]
+    if body is not None and time.monotonic() - _last_good["ts"] < PRICE_FRESH_AGE:
+        return price_response(body, True)
+
+    stale = stale_price_response()
+    if stale is not None:
+        # Refresh in the background, at most once per process
+        if _refresh_lock.acquire(blocking=False):
+            threading.Thread(target=refresh_price_body, daemon=True).start()
+        return stale
+
+    return price_response(*query_price_body())
+
+
 @app.route("/price")
 @limiter.limit("1 per second")
 def price():
-    return jsonify(get_prices())
+    try:
+        body = cache_redis.get(PRICE_CACHE_KEY)
+    except redis.RedisError as e:
+        logger.warning(f'Price cache read failed: {e}')
+        return outage_price_response()
+
+    if body is not None:
+        return price_response(body, True)
+
+    body, ok = build_price_body()
+    if not ok:
+        # The rebuild failed or another worker still holds the lock
+        stale = stale_price_response()
+        if stale is not None:
+            return stale
+        if body is None:
+            body, ok = query_price_body()
+    return price_response(body, ok)
 
 
 if __name__ == "__main__":
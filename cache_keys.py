@@ -0,0 +1,9 @@
+"""Redis keys shared by the Flask app and the Celery worker."""
+
+# Serialized /price response body
+PRICE_CACHE_KEY = 'price_json'
+
+# Bumped by fetch_data after each insert. A /price rebuild only stores its
+# body if the generation is unchanged since it started, so a rebuild that
+# read the database before the insert can't overwrite the newer data.
+PRICE_GENERATION_KEY = 'price_generation'
@@ -1,10 +1,18 @@
 from celery import Celery
-from celery.schedules import timedelta
+from celery.schedules import crontab, timedelta
+import redis
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 from psycopg2 import pool, OperationalError
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
+from cache_keys import PRICE_CACHE_KEY, PRICE_GENERATION_KEY
+import orjson
+import math
 import os
+import random
 import sys
 import logging
 
@@ -36,22 +44,88 @@ except OperationalError as e:
     logger.error(f'Failed to create database connection pool: {e}')
     raise
 
+# Redis holding the Flask app's /price cache, for invalidating it after inserts
+# Short timeouts so a hung Redis can't hold fetch_data until its time limit
+cache_redis = redis.Redis.from_url(
+    os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+    socket_connect_timeout=2,
+    socket_timeout=2
+)
+
 app = Celery('tasks', broker=os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/1'))
 
-# Schedule the fetch_data task to run every 30 seconds
+FETCH_MAX_RETRIES = 3
+RETRY_BASE_DELAY = 60  # seconds
+RATE_LIMIT_RETRY_BASE_DELAY = 120  # seconds, for CoinGecko 429 error bodies
+RETRY_MAX_DELAY = 3600  # seconds
+# Longest countdown fetch_data can request: the last allowed retry runs with
+# self.request.retries == FETCH_MAX_RETRIES - 1
+MAX_RETRY_COUNTDOWN = min(
+    RETRY_MAX_DELAY,
+    RATE_LIMIT_RETRY_BASE_DELAY * 2 ** (FETCH_MAX_RETRIES - 1)
+)
+
+# Ack after completion so a killed worker's task is redelivered, and fetch one
+# task at a time so a slow run can't hold others back. Time limits are set
+# per task (fetch_data) rather than globally. Delayed retries stay unacked
+# until they run, so the visibility timeout must outlast the longest retry
+# countdown or Redis would redeliver them early; beyond that, keep it short
+# so a task orphaned by a killed worker is redelivered promptly.
+app.conf.update(
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    broker_transport_options={'visibility_timeout': MAX_RETRY_COUNTDOWN + 300},
+)
+
+# Schedule the fetch_data task to run every 30 seconds and prune old rows
+# daily. crontab fires at a fixed time, so restarting beat doesn't delay it.
 app.conf.beat_schedule = {
     'fetch-every-30-seconds': {
         'task': 'tasks.fetch_data',
         'schedule': timedelta(seconds=30),
     },
+    'prune-daily': {
+        'task': 'tasks.prune_prices',
+        'schedule': crontab(hour=3, minute=0),
+    },
 }
 
 COINGECKO_API_URL = 'https://api.coingecko.com/api/v3/simple/price'
 COINGECKO_PARAMS = 'ids=zenon-2,bitcoin,quasar-2,ethereum&vs_currencies=usd'
 REQUEST_TIMEOUT = 10  # seconds
+INSERT_PRICES_SQL = 'INSERT INTO coingecko (currency_id, currency_value) VALUES %s'
+# Latest value per currency as one LIMIT 1 primary key probe each
+LATEST_PRICES_SQL = '''
+    SELECT c.id, l.currency_value
+    FROM unnest(%s::text[]) AS c(id)
+    CROSS JOIN LATERAL (
+        SELECT currency_value
+        FROM coingecko
+        WHERE currency_id = c.id
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ) l
+'''
+# Relative tolerance for treating a price as unchanged; currency_value is a
+# REAL, so stored values only match the API to about 7 significant digits
+PRICE_CHANGE_TOLERANCE = 1e-6
+PRICE_RETENTION_DAYS = 30
+
+# Shared HTTP session so the TLS connection to CoinGecko is kept alive
+# between runs. Transport retries are disabled; Celery handles retries.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(max_retries=Retry(total=0), pool_maxsize=2))
+
+_random = random.SystemRandom()
+
 
+def backoff(retries, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Exponential backoff with full jitter, so workers don't retry in lockstep."""
+    return _random.uniform(0, min(cap, base * (2 ** retries)))
 
-@app.task(bind=True, max_retries=3, default_retry_delay=60)
+
+# Time limits sit above REQUEST_TIMEOUT so a hung API call can't block the queue
+@app.task(bind=True, max_retries=FETCH_MAX_RETRIES, default_retry_delay=RETRY_BASE_DELAY, soft_time_limit=20, time_limit=30)
 def fetch_data(self):
     """Fetch cryptocurrency prices from CoinGecko and store in database."""
     db = None
@@ -61,33 +135,34 @@ def fetch_data(self):
         # Get database connection
         logger.debug('Getting connection from pool')
         db = cnxpool.getconn()
+        db.autocommit = False
         cursor = db.cursor()
 
         # Query the CoinGecko API
         logger.info('Fetching data from CoinGecko API')
         try:
-            response = requests.get(
+            response = session.get(
                 f'{COINGECKO_API_URL}?{COINGECKO_PARAMS}',
                 timeout=REQUEST_TIMEOUT
             )
         except RequestException as e:
             logger.error(f'HTTP request failed: {e}')
-            raise self.retry(exc=e, countdown=60 * (2 ** self.request.retries))
+            raise self.retry(exc=e, countdown=backoff(self.request.retries))
 
         # Check HTTP status code
         if response.status_code != 200:
             logger.error(f'CoinGecko API returned status {response.status_code}: {response.text[:200]}')
             if response.status_code in (429, 500, 502, 503, 504):
                 # Retryable errors
-                raise self.retry(countdown=60 * (2 ** self.request.retries))
+                raise self.retry(countdown=backoff(self.request.retries))
             return  # Non-retryable error, skip this run
 
         # Parse JSON response
         try:
-            data = response.json()
+            data = orjson.loads(response.content)
         except ValueError as e:
             logger.error(f'Failed to parse JSON response: {e}')
-            raise self.retry(exc=e, countdown=60)
+            raise self.retry(exc=e, countdown=backoff(self.request.retries))
 
         # Check for API error response
         if 'status' in data and 'error_code' in data.get('status', {}):
@@ -95,7 +170,7 @@ def fetch_data(self):
             error_msg = data['status'].get('error_message', 'Unknown error')
             logger.error(f'CoinGecko API error {error_code}: {error_msg}')
             if error_code == 429:
-                raise self.retry(countdown=120)
+                raise self.retry(countdown=backoff(self.request.retries, base=RATE_LIMIT_RETRY_BASE_DELAY))
             return
 
         # Validate response structure
@@ -103,9 +178,8 @@ def fetch_data(self):
             logger.error(f'Unexpected API response format: {type(data)}')
             return
 
-        # Insert each currency into the database
-        logger.info('Inserting data into the database')
-        inserted_count = 0
+        # Collect valid rows and insert them in a single statement
+        rows = []
         for currency_id, currency_data in data.items():
             if not isinstance(currency_data, dict):
                 logger.warning(f'Skipping {currency_id}: invalid data format')
@@ -116,24 +190,44 @@ def fetch_data(self):
                 logger.warning(f'Skipping {currency_id}: no USD value found')
                 continue
 
-            try:
-                cursor.execute("""
-                    INSERT INTO coingecko (currency_id, currency_value)
-                    VALUES (%s, %s)
-                """, (currency_id, usd_value))
-                inserted_count += 1
-            except Exception as e:
-                logger.error(f'Failed to insert {currency_id}: {e}')
-                continue
+            rows.append((currency_id, usd_value))
+
+        # Skip currencies whose price hasn't changed since the last insert
+        if rows:
+            cursor.execute(LATEST_PRICES_SQL, ([cid for cid, _ in rows],))
+            last_values = dict(cursor.fetchall())
+            rows = [
+                (cid, usd) for cid, usd in rows
+                if cid not in last_values
+                or not math.isclose(usd, last_values[cid], rel_tol=PRICE_CHANGE_TOLERANCE)
+            ]
+
+        logger.info('Inserting data into the database')
+        if rows:
+            execute_values(cursor, INSERT_PRICES_SQL, rows, page_size=len(rows))
+        inserted_count = len(rows)
 
         db.commit()
-        logger.info(f'Successfully inserted {inserted_count} price records')
+        logger.info(f'Successfully inserted {inserted_count} changed price records')
+
+        # Drop the cached /price response so the next request sees new data,
+        # and bump the generation so an in-flight rebuild can't restore it
+        if inserted_count:
+            try:
+                with cache_redis.pipeline() as pipe:
+                    pipe.incr(PRICE_GENERATION_KEY)
+                    pipe.delete(PRICE_CACHE_KEY)
+                    pipe.execute()
+            except redis.RedisError as e:
+                logger.warning(f'Failed to invalidate price cache: {e}')
 
     except self.MaxRetriesExceededError:
         logger.error('Max retries exceeded for fetch_data task')
         raise
     except Exception as e:
         logger.error(f'Unexpected error in fetch_data: {e}')
+        if db:
+            db.rollback()
         raise
     finally:
         # Always return connection to pool
@@ -142,3 +236,40 @@ def fetch_data(self):
         if db:
             cnxpool.putconn(db)
             logger.debug('Database connection returned to pool')
+
+
+@app.task
+def prune_prices():
+    """Delete price records older than PRICE_RETENTION_DAYS.
+
+    The latest row per currency is always kept, so a price that hasn't
+    changed within the retention window still shows up in /price.
+    """
+    db = None
+    cursor = None
+
+    try:
+        db = cnxpool.getconn()
+        db.autocommit = False
+        cursor = db.cursor()
+        cursor.execute("""
+            DELETE FROM coingecko c
+            WHERE c.timestamp < now() - make_interval(days => %s)
+            AND c.timestamp < (
+                SELECT max(l.timestamp) FROM coingecko l
+                WHERE l.currency_id = c.currency_id
+            )
+        """, (PRICE_RETENTION_DAYS,))
+        deleted_count = cursor.rowcount
+        db.commit()
+        logger.info(f'Pruned {deleted_count} price records older than {PRICE_RETENTION_DAYS} days')
+    except Exception as e:
+        logger.error(f'Unexpected error in prune_prices: {e}')
+        if db:
+            db.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if db:
+            cnxpool.putconn(db)